@@ -2,18 +2,50 @@
 from __future__ import annotations
 
 import ast
+import functools
+import hashlib
 import json
+import math
+import multiprocessing
 import os
+import re
+import shutil
 import sys
+import threading
 import time
-from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 from urllib.error import HTTPError, URLError
 from urllib.parse import urlencode, unquote, urlparse
 from urllib.request import Request, urlopen
 try:
     import requests  # type: ignore
+    from requests.adapters import HTTPAdapter  # type: ignore
+    from urllib3.util.retry import Retry  # type: ignore
 except Exception:
     requests = None  # type: ignore
+try:
+    import httpx  # type: ignore
+    import h2  # type: ignore  # noqa: F401  (httpx needs it for http2=True)
+except Exception:
+    httpx = None  # type: ignore
+try:
+    import pypdfium2 as pdfium  # type: ignore
+except Exception:
+    pdfium = None  # type: ignore
+try:
+    from pypdf import PdfReader  # type: ignore
+except Exception:
+    PdfReader = None  # type: ignore
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None  # type: ignore
 
 
 BASE_API = "https://chorig.org/wp-json/app/v1/categories/{category_id}/prayers/"
@@ -22,42 +54,434 @@ DEFAULT_HEADERS = {
     "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
 }
 
+# A queued PDF text extraction: its future, the PDF path and the output directory.
+PdfJob = Tuple[Future, str, str]
+
+# Responses worth retrying with backoff.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+API_RETRIES = 5
+
+# Upper bound on simultaneous asset downloads; stays below the session pool size.
+ASSET_WORKERS = 8
+# Number of categories crawled at the same time.
+CATEGORY_WORKERS = 8
+# Buffer size for destination files, so large chunks reach the kernel in few write() calls.
+WRITE_BUFFER_SIZE = 4 << 20
+# Directory under the output root holding the shared, deduplicated asset bytes.
+BLOB_DIRNAME = "blobs"
+# Number of API pages requested ahead of the one being processed.
+PAGE_PREFETCH = 4
+# Threads fetching API pages for one category.
+PAGE_WORKERS = 8
+# Upper bound on simultaneous requests to a single host.
+HOST_CONCURRENCY = 8
+# Cool-down applied when a host throttles without saying for how long, and the cap on any cool-down.
+RATE_LIMIT_DEFAULT_DELAY = 5.0
+RATE_LIMIT_MAX_DELAY = 120.0
+
+
+def _build_session() -> Optional["requests.Session"]:
+    """
+    Build a shared session so that API pages and asset downloads reuse
+    pooled keep-alive connections instead of a new TCP+TLS handshake per call.
+    """
+    if requests is None:
+        return None
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=64,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=RETRY_STATUSES,
+            # Hand the final throttled response back so its headers can be inspected
+            raise_on_status=False,
+        ),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _build_api_client() -> Optional["httpx.Client"]:
+    """
+    Build an HTTP/2 client for the chorig.org API so that prefetched pages are
+    multiplexed over a single connection. Only used when httpx[http2] is installed.
+    """
+    if httpx is None:
+        return None
+    return httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        timeout=30,
+        headers=DEFAULT_HEADERS,
+        follow_redirects=True,
+    )
+
+
+# Shared clients and executors are built on first use rather than at import:
+# spawned PDF workers re-import this module and must not build their own.
+_LAZY_LOCK = threading.Lock()
+_SESSION: Optional["requests.Session"] = None
+_API_CLIENT: Optional["httpx.Client"] = None
+_ASSET_POOL: Optional[ThreadPoolExecutor] = None
+_PDF_POOL: Optional[ProcessPoolExecutor] = None
+
+
+def _session() -> Optional["requests.Session"]:
+    global _SESSION
+    if _SESSION is None and requests is not None:
+        with _LAZY_LOCK:
+            if _SESSION is None:
+                _SESSION = _build_session()
+    return _SESSION
+
+
+def _api_client() -> Optional["httpx.Client"]:
+    global _API_CLIENT
+    if _API_CLIENT is None and httpx is not None:
+        with _LAZY_LOCK:
+            if _API_CLIENT is None:
+                _API_CLIENT = _build_api_client()
+    return _API_CLIENT
+
+
+def _asset_pool() -> ThreadPoolExecutor:
+    global _ASSET_POOL
+    if _ASSET_POOL is None:
+        with _LAZY_LOCK:
+            if _ASSET_POOL is None:
+                _ASSET_POOL = ThreadPoolExecutor(max_workers=ASSET_WORKERS)
+    return _ASSET_POOL
+
+
+def _spawn_context() -> Any:
+    # PDF workers are spawned rather than forked: pools are fed from download
+    # threads, and forking a multi-threaded process can deadlock the child.
+    return multiprocessing.get_context("spawn")
+
+
+def _pdf_pool(replace: Optional[ProcessPoolExecutor] = None) -> ProcessPoolExecutor:
+    """
+    Return the PDF extraction pool. Passing the current pool as `replace`
+    discards it (e.g. after a worker crashed and broke it) and starts a new one.
+    """
+    global _PDF_POOL
+    with _LAZY_LOCK:
+        if replace is not None and _PDF_POOL is replace:
+            replace.shutdown(wait=False, cancel_futures=True)
+            _PDF_POOL = None
+        if _PDF_POOL is None:
+            _PDF_POOL = ProcessPoolExecutor(mp_context=_spawn_context())
+        return _PDF_POOL
+
+
+_HOST_LOCK = threading.Lock()
+_host_slots: Dict[str, threading.BoundedSemaphore] = {}
+_host_resume_at: Dict[str, float] = {}
+
+_copy_buffers = threading.local()
+
+_created_dirs: Set[str] = set()
+
+_BLOB_LOCK = threading.Lock()
+_blob_locks: Dict[str, threading.Lock] = {}
+# Blobs already fetched or revalidated during this run
+_fresh_blobs: Set[str] = set()
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def _note_rate_limit(url: str, status: int, headers: Any) -> None:
+    """
+    Record a cool-down for the URL's host when the server throttles us, based on
+    Retry-After or the X-RateLimit-Remaining/X-RateLimit-Reset pair.
+    """
+    delay = None
+    if status in (429, 503):
+        delay = _parse_retry_after(headers.get("Retry-After"))
+        if delay is None:
+            delay = RATE_LIMIT_DEFAULT_DELAY
+    elif str(headers.get("X-RateLimit-Remaining", "")).strip() == "0":
+        reset = headers.get("X-RateLimit-Reset")
+        try:
+            reset_at = float(reset)
+        except (TypeError, ValueError):
+            reset_at = None
+        if reset_at is not None:
+            # Some servers send an epoch timestamp, others a number of seconds
+            delay = reset_at - time.time() if reset_at > 1e9 else reset_at
+    if delay is None or delay <= 0:
+        return
+    host = urlparse(url).netloc
+    with _HOST_LOCK:
+        resume_at = time.time() + min(delay, RATE_LIMIT_MAX_DELAY)
+        _host_resume_at[host] = max(_host_resume_at.get(host, 0.0), resume_at)
+
+
+@contextmanager
+def _host_slot(url: str) -> Iterator[None]:
+    """
+    Limit in-flight requests per host and honour any pending cool-down.
+    """
+    host = urlparse(url).netloc
+    with _HOST_LOCK:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = threading.BoundedSemaphore(HOST_CONCURRENCY)
+    with slot:
+        while True:
+            with _HOST_LOCK:
+                pause = _host_resume_at.get(host, 0.0) - time.time()
+            if pause <= 0:
+                break
+            time.sleep(pause)
+        yield
+
+
+def _urlopen(req: Request, timeout: int) -> Any:
+    try:
+        return urlopen(req, timeout=timeout)
+    except HTTPError as e:
+        _note_rate_limit(req.full_url, e.code, e.headers)
+        raise
+
+
+_BAD_CHARS_RE = re.compile(r'[\\/:*?"<>|]')
+_MULTI_SPACE_RE = re.compile(r" {2,}")
+# scheme://netloc/.../<last segment>, stopping at params, query or fragment
+# (tab/CR/LF are excluded: urlsplit strips them, so such URLs take the slow path)
+_URL_TAIL_RE = re.compile(
+    r"[A-Za-z][A-Za-z0-9+.-]*://[^/?#\t\r\n]*/(?:[^?#\t\r\n]*/)?"
+    r"([^/?#;\t\r\n]+)(?:;[^/?#\t\r\n]*)?(?:[?#]|\Z)"
+)
+
 
 def sanitize_name(raw: str) -> str:
     if not raw:
         return "Untitled"
     # Replace filesystem-unfriendly characters
-    bad_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
-    name = "".join('-' if c in bad_chars else c for c in raw)
+    name = _BAD_CHARS_RE.sub("-", raw)
     name = name.strip().strip(".")
-    while "  " in name:
-        name = name.replace("  ", " ")
+    name = _MULTI_SPACE_RE.sub(" ", name)
     return name or "Untitled"
 
 
 def ensure_dir(path: str) -> None:
+    # Directories are requested over and over (per prayer, per asset); only
+    # hit the filesystem the first time we see a path.
+    if path in _created_dirs:
+        return
     os.makedirs(path, exist_ok=True)
+    _created_dirs.add(path)
+
+
+def _json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode("utf-8"))
 
 
 def http_get_json(url: str, params: Optional[Dict[str, Any]] = None, timeout: int = 30) -> Dict[str, Any]:
-    if requests is not None:
-        resp = requests.get(url, params=params, headers=DEFAULT_HEADERS, timeout=timeout)
+    client = _api_client()
+    if client is not None:
+        for attempt in range(API_RETRIES + 1):
+            try:
+                with _host_slot(url):
+                    resp = client.get(url, params=params, timeout=timeout)
+            except httpx.TransportError:
+                # Dropped connections and timeouts: retry like urllib3 does for requests
+                if attempt == API_RETRIES:
+                    raise
+                time.sleep(0.5 * 2 ** attempt)
+                continue
+            _note_rate_limit(url, resp.status_code, resp.headers)
+            if resp.status_code not in RETRY_STATUSES or attempt == API_RETRIES:
+                break
+            time.sleep(0.5 * 2 ** attempt)
+        resp.raise_for_status()
+        return _json_loads(resp.content)
+    session = _session()
+    if session is not None:
+        with _host_slot(url):
+            resp = session.get(url, params=params, timeout=timeout)
+        _note_rate_limit(url, resp.status_code, resp.headers)
         resp.raise_for_status()
-        return resp.json()
+        return _json_loads(resp.content)
     # Fallback to urllib
     if params:
         qs = urlencode(params, doseq=True)
         sep = "&" if "?" in url else "?"
         url = f"{url}{sep}{qs}"
     req = Request(url, headers=DEFAULT_HEADERS, method="GET")
-    with urlopen(req, timeout=timeout) as r:
+    with _host_slot(url), _urlopen(req, timeout=timeout) as r:
         data = r.read()
-    return json.loads(data.decode("utf-8"))
+    return _json_loads(data)
 
 
-def stream_download(url: str, dest_path: str, timeout: int = 60, chunk_size: int = 1 << 20) -> None:
-    if os.path.exists(dest_path) and os.path.getsize(dest_path) > 0:
+def _probe_remote(url: str, headers: Dict[str, str], timeout: int) -> Tuple[Optional[int], Optional[str]]:
+    """
+    Return the remote (Content-Length, ETag) of a URL via a HEAD request, or
+    (None, None) when the server does not tell us.
+    """
+    try:
+        session = _session()
+        if session is not None:
+            resp = session.head(url, headers=headers, allow_redirects=True, timeout=timeout)
+            _note_rate_limit(url, resp.status_code, resp.headers)
+            resp.raise_for_status()
+            resp_headers = resp.headers
+        else:
+            with _urlopen(Request(url, headers=headers, method="HEAD"), timeout=timeout) as r:
+                resp_headers = r.headers
+    except Exception:
+        return None, None
+    try:
+        size: Optional[int] = int(resp_headers.get("Content-Length"))
+    except (TypeError, ValueError):
+        size = None
+    return size, resp_headers.get("ETag")
+
+
+def _read_etag(dest_path: str) -> Optional[str]:
+    try:
+        with open(dest_path + ".etag", "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def _write_etag(dest_path: str, etag: Optional[str]) -> None:
+    if not etag:
+        # Never leave a stale validator next to bytes it does not describe
+        try:
+            os.remove(dest_path + ".etag")
+        except OSError:
+            pass
+        return
+    with open(dest_path + ".etag", "w", encoding="utf-8") as f:
+        f.write(etag)
+
+
+def _discard(dest_path: str) -> None:
+    for path in (dest_path, dest_path + ".etag"):
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
+
+def _copy_stream(src: Any, dst: Any, chunk_size: int) -> None:
+    """
+    Copy src to dst through a per-thread buffer that is reused across chunks
+    and downloads. Only worth it for streams with a native readinto(), such as
+    http.client responses; urllib3 emulates it with read() and an extra copy.
+    """
+    buf = getattr(_copy_buffers, "buf", None)
+    if buf is None or len(buf) != chunk_size:
+        buf = _copy_buffers.buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    while True:
+        n = src.readinto(buf)
+        if not n:
+            break
+        dst.write(view[:n])
+
+
+def _check_pdf_head(head: bytes, content_type: str, dest_path: str) -> None:
+    if not head or (not head.startswith(b"%PDF-") and "pdf" not in content_type):
+        _discard(dest_path)
+        raise RuntimeError(
+            f"Downloaded content is not a PDF (Content-Type: {content_type or 'unknown'})"
+        )
+
+
+def _check_complete(part_path: str, offset: int, written: int, resp_headers: Any) -> None:
+    """
+    Refuse to publish a transfer that ended short of the advertised length; the
+    partial file is kept so the next run can resume it.
+    """
+    encoding = (resp_headers.get("Content-Encoding") or "identity").lower()
+    try:
+        expected = int(resp_headers.get("Content-Length"))
+    except (TypeError, ValueError):
         return
+    # Content-Length counts encoded bytes, which we decode on the fly
+    if encoding == "identity" and written - offset < expected:
+        raise RuntimeError(
+            f"Transfer ended early: got {written - offset} of {expected} bytes for {part_path}"
+        )
+
+
+def _publish(part_path: str, dest_path: str) -> None:
+    # os.replace gives dest_path a new inode; anything hard-linked to the old
+    # file (see cached_download) keeps the old, intact bytes.
+    os.replace(part_path, dest_path)
+    if os.path.exists(part_path + ".etag"):
+        os.replace(part_path + ".etag", dest_path + ".etag")
+    else:
+        _write_etag(dest_path, None)
+
+
+def _write_part(
+    part_path: str,
+    ext: str,
+    offset: int,
+    local_head: bytes,
+    status: int,
+    resp_headers: Any,
+    head: bytes,
+    copy_rest: Callable[[BinaryIO], None],
+) -> None:
+    """
+    Write a GET response into part_path, shared by both transports. `offset`
+    is where a Range request asked to resume and `local_head` the first bytes
+    already on disk; `head` is the peeked start of the body and `copy_rest`
+    streams the remainder into the open file.
+    """
+    content_type = (resp_headers.get("Content-Type") or "").lower()
+    etag = resp_headers.get("ETag")
+    if status != 206:
+        # Server ignored the Range header (or If-Range failed); start over
+        offset = 0
+    # Validate PDFs from the first bytes before anything is written
+    if ext.lower() == ".pdf" or "pdf" in content_type:
+        _check_pdf_head(local_head if offset else head, content_type, part_path)
+    if not offset:
+        # Record the validator up front so an interrupted download
+        # can later be resumed safely (or recognised as stale).
+        _write_etag(part_path, etag)
+    with open(part_path, "ab" if offset else "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(head)
+        copy_rest(f)
+        written = f.tell()
+    _check_complete(part_path, offset, written, resp_headers)
+
+
+def stream_download(url: str, dest_path: str, timeout: int = 60, chunk_size: int = 1 << 20) -> None:
+    """
+    Download url to dest_path. An existing file is revalidated against the
+    remote Content-Length/ETag and skipped when it is current. New bytes are
+    written to a '.part' file that is only renamed over dest_path once
+    complete, so dest_path itself is never rewritten in place. An interrupted
+    '.part' is resumed with a Range/If-Range request when its recorded ETag
+    still matches the server's.
+    """
     ensure_dir(os.path.dirname(dest_path))
     # Build robust headers, including a sane Referer for hosts that require it
     parsed = urlparse(url)
@@ -65,67 +489,119 @@ def stream_download(url: str, dest_path: str, timeout: int = 60, chunk_size: int
     if parsed.scheme and parsed.netloc:
         headers.setdefault("Referer", f"{parsed.scheme}://{parsed.netloc}/")
     headers.setdefault("Accept", "application/pdf,application/octet-stream;q=0.9,*/*;q=0.8")
-
-    if requests is not None:
-        with requests.get(
-            url,
-            stream=True,
-            headers=headers,
-            timeout=timeout,
-            allow_redirects=True,
-        ) as r:
-            r.raise_for_status()
-            content_type = (r.headers.get("Content-Type") or "").lower()
-            first_chunk: Optional[bytes] = None
-            with open(dest_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=chunk_size):
-                    if not chunk:
-                        continue
-                    if first_chunk is None:
-                        first_chunk = chunk
-                    f.write(chunk)
-            # Validate PDF downloads when applicable
-            _, ext = os.path.splitext(dest_path)
-            if (ext.lower() == ".pdf" or "pdf" in content_type):
-                if not first_chunk or (not first_chunk.startswith(b"%PDF-") and "pdf" not in content_type):
-                    try:
-                        os.remove(dest_path)
-                    except Exception:
-                        pass
-                    raise RuntimeError(
-                        f"Downloaded content is not a PDF (Content-Type: {content_type or 'unknown'})"
-                    )
-        return
-    # urllib fallback
-    req = Request(url, headers=headers, method="GET")
-    with urlopen(req, timeout=timeout) as r:
-        content_type = (r.headers.get("Content-Type") or "").lower()
-        first_chunk: Optional[bytes] = None
-        with open(dest_path, "wb") as f:
-            while True:
-                chunk = r.read(chunk_size)
-                if not chunk:
-                    break
-                if first_chunk is None and chunk:
-                    first_chunk = chunk
-                f.write(chunk)
-    # Validate PDF downloads when applicable (urllib path)
     _, ext = os.path.splitext(dest_path)
-    if ext.lower() == ".pdf":
-        if not first_chunk or not first_chunk.startswith(b"%PDF-"):
-            try:
-                os.remove(dest_path)
-            except Exception:
-                pass
-            raise RuntimeError("Downloaded content is not a PDF")
+    part_path = dest_path + ".part"
+
+    with _host_slot(url):
+        offset = 0
+        local_head = b""
+        probe: Optional[Tuple[Optional[int], Optional[str]]] = None
+        local_size = os.path.getsize(dest_path) if os.path.exists(dest_path) else 0
+        if local_size > 0:
+            probe = remote_size, etag = _probe_remote(url, headers, timeout)
+            stored_etag = _read_etag(dest_path)
+            same_etag = not etag or not stored_etag or etag == stored_etag
+            if remote_size is None and same_etag:
+                # Nothing to compare against; trust what is on disk
+                return
+            if local_size == remote_size and same_etag:
+                return
+        part_size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if part_size > 0:
+            remote_size, etag = probe if probe is not None else _probe_remote(url, headers, timeout)
+            # Only resume bytes we can prove belong to the current remote version:
+            # the ETag recorded when the download started must still match, and
+            # If-Range makes the server send the full body if it does not.
+            stored_etag = _read_etag(part_path)
+            can_resume = bool(etag and stored_etag == etag and not etag.startswith("W/"))
+            if remote_size is not None and part_size < remote_size and can_resume:
+                offset = part_size
+                headers["Range"] = f"bytes={offset}-"
+                headers["If-Range"] = etag
+                # The PDF header of a resumed download is already on disk
+                with open(part_path, "rb") as f:
+                    local_head = f.read(8)
+
+        session = _session()
+        if session is not None:
+            with session.get(
+                url,
+                stream=True,
+                headers=headers,
+                timeout=timeout,
+                allow_redirects=True,
+            ) as r:
+                _note_rate_limit(url, r.status_code, r.headers)
+                r.raise_for_status()
+                # urllib3's readinto() is read() plus a copy, so a reused buffer
+                # buys nothing here; let copyfileobj stream the body.
+                r.raw.decode_content = True
+                _write_part(
+                    part_path, ext, offset, local_head, r.status_code, r.headers, r.raw.read(8),
+                    lambda f: shutil.copyfileobj(r.raw, f, length=chunk_size),
+                )
+        else:
+            # urllib fallback
+            req = Request(url, headers=headers, method="GET")
+            with _urlopen(req, timeout=timeout) as r:
+                _write_part(
+                    part_path, ext, offset, local_head, r.status, r.headers, r.read(8),
+                    lambda f: _copy_stream(r, f, chunk_size),
+                )
+
+    _publish(part_path, dest_path)
+
+
+def _link_into_place(blob_path: str, dest_path: str) -> None:
+    if os.path.exists(dest_path) and os.path.samefile(blob_path, dest_path):
+        return
+    ensure_dir(os.path.dirname(dest_path))
+    tmp_path = dest_path + ".tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(blob_path, tmp_path)
+    except OSError:
+        # No hard links here (other filesystem, unsupported); try a symlink, then a copy
+        try:
+            os.symlink(os.path.abspath(blob_path), tmp_path)
+        except OSError:
+            shutil.copyfile(blob_path, tmp_path)
+    os.replace(tmp_path, dest_path)
 
 
-def load_category_mapping(mapping_path: str) -> Dict[int, str]:
+def cached_download(url: str, dest_path: str, blob_root: str) -> None:
+    """
+    Download url through a content store shared by all prayers: the bytes live
+    once under blob_root (keyed by the SHA-256 of the URL) and dest_path is
+    hard-linked to them, so assets referenced by many prayers are fetched and
+    stored only once.
+    """
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    _, ext = os.path.splitext(dest_path)
+    # Keep the extension so stream_download still applies the PDF checks
+    blob_path = os.path.join(blob_root, key[:2], f"{key}{ext.lower()}")
+    with _BLOB_LOCK:
+        lock = _blob_locks.get(blob_path)
+        if lock is None:
+            lock = _blob_locks[blob_path] = threading.Lock()
+    with lock:
+        if blob_path not in _fresh_blobs:
+            stream_download(url, blob_path)
+            _fresh_blobs.add(blob_path)
+    _link_into_place(blob_path, dest_path)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_mapping_cached(mapping_path: str, mtime: float) -> Dict[int, str]:
     with open(mapping_path, "r", encoding="utf-8") as f:
         raw = f.read()
     try:
-        data = json.loads(raw)
-    except json.JSONDecodeError:
+        if orjson is not None:
+            data = orjson.loads(raw)
+        else:
+            data = json.loads(raw)
+    except ValueError:
         # The file appears to be a Python dict literal (keys unquoted). Fall back safely.
         data = ast.literal_eval(raw)
     mapping: Dict[int, str] = {}
@@ -139,39 +615,72 @@ def load_category_mapping(mapping_path: str) -> Dict[int, str]:
     return mapping
 
 
-def iter_prayers(category_id: int) -> Iterable[Dict[str, Any]]:
+def load_category_mapping(mapping_path: str) -> Dict[int, str]:
+    """
+    Parse the category mapping, reusing the previous result until the file changes.
+    """
+    return dict(_load_mapping_cached(mapping_path, os.path.getmtime(mapping_path)))
+
+
+def iter_prayers(category_id: int, prefetch: int = PAGE_PREFETCH) -> Iterable[Dict[str, Any]]:
     """
     Iterate prayers for a category using page number embedded in the URL path.
     Page numbering starts from 0 and continues until the API returns an empty
-    'prayers' array.
+    'prayers' array. Once page 0 reports 'totalCount', exactly the remaining
+    pages are requested at once; without it, up to `prefetch` pages are
+    requested ahead of the one being consumed.
     """
     seen_ids: Set[int] = set()
     base_url = BASE_API.format(category_id=category_id)
     total_count: Optional[int] = None
 
-    page = 0
-    while True:
-        page_url = f"{base_url}{page}"
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+        pending: Deque[Future] = deque()
+        next_page = 0
+        page_size: Optional[int] = None
+        num_pages: Optional[int] = None
         try:
-            data = http_get_json(page_url)
-        except Exception:
-            break
-        total_count = data.get("totalCount", total_count)
-        prayers = data.get("prayers") or []
-        if not prayers:
-            break
-        for p in prayers:
-            if not isinstance(p, dict):
-                continue
-            pid = p.get("id")
-            if isinstance(pid, int):
-                if pid in seen_ids:
-                    continue
-                seen_ids.add(pid)
-            yield p
-        if total_count is not None and len(seen_ids) >= int(total_count):
-            break
-        page += 1
+            while True:
+                if num_pages is None:
+                    # Page 0 is fetched alone since it may tell us the page count;
+                    # only when it does not do we scan ahead speculatively.
+                    window = 1 if next_page == 0 else max(1, prefetch)
+                    while len(pending) < window:
+                        pending.append(pool.submit(http_get_json, f"{base_url}{next_page}"))
+                        next_page += 1
+                if not pending:
+                    break
+                try:
+                    data = pending.popleft().result()
+                except Exception:
+                    break
+                total_count = data.get("totalCount", total_count)
+                prayers = data.get("prayers") or []
+                if not prayers:
+                    break
+                if page_size is None:
+                    page_size = len(prayers)
+                if num_pages is None and total_count is not None:
+                    # Request every remaining page now, and nothing past the last one
+                    num_pages = math.ceil(int(total_count) / page_size)
+                    while next_page < num_pages:
+                        pending.append(pool.submit(http_get_json, f"{base_url}{next_page}"))
+                        next_page += 1
+                for p in prayers:
+                    if not isinstance(p, dict):
+                        continue
+                    pid = p.get("id")
+                    if isinstance(pid, int):
+                        if pid in seen_ids:
+                            continue
+                        seen_ids.add(pid)
+                    yield p
+                if total_count is not None and len(seen_ids) >= int(total_count):
+                    break
+        finally:
+            # Drop speculative requests for pages past the end
+            for future in pending:
+                future.cancel()
 
 
 def build_category_dirname(category_id: int, title: str) -> str:
@@ -185,28 +694,53 @@ def build_prayer_dirname(prayer: Dict[str, Any]) -> str:
 
 
 def filename_from_url(url: str, fallback: str) -> str:
-    parsed = urlparse(url)
-    raw = unquote(os.path.basename(parsed.path)) or fallback
+    # Fast path: pull the last path segment straight out of the URL; only
+    # unusual URLs fall through to a full urlparse.
+    m = _URL_TAIL_RE.match(url)
+    if m:
+        raw = unquote(m.group(1)) or fallback
+    else:
+        parsed = urlparse(url)
+        raw = unquote(os.path.basename(parsed.path)) or fallback
     return sanitize_name(raw)
 
 
-def unique_filename(directory: str, base_name: str) -> str:
+def unique_filename(base_name: str, taken: Set[str]) -> str:
     """
     Ensure filename uniqueness by appending numeric suffix if needed.
+    Uniqueness is checked against (and recorded in) `taken` rather than the
+    files on disk, so a rerun maps onto the same names.
     """
     root, ext = os.path.splitext(base_name)
     candidate = base_name
     counter = 1
-    while os.path.exists(os.path.join(directory, candidate)):
+    while candidate in taken:
         candidate = f"{root} ({counter}){ext}"
         counter += 1
+    taken.add(candidate)
     return candidate
 
 
 def save_metadata(prayer_dir: str, prayer: Dict[str, Any]) -> None:
+    """
+    Serialize the prayer in one go and publish it atomically, so an interrupted
+    run never leaves a truncated metadata.json behind.
+    """
     meta_path = os.path.join(prayer_dir, "metadata.json")
-    with open(meta_path, "w", encoding="utf-8") as f:
-        json.dump(prayer, f, ensure_ascii=False, indent=2)
+    if orjson is not None:
+        data = orjson.dumps(prayer, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        data = json.dumps(prayer, ensure_ascii=False, indent=2).encode("utf-8")
+    tmp_path = meta_path + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, meta_path)
+
 
 def pdf_to_txt(file_path: Path, output_dir: Path, extracted_text: str):
     """Converts pdf file to a txt file"""
@@ -223,78 +757,186 @@ def pdf_to_txt(file_path: Path, output_dir: Path, extracted_text: str):
 
 
 def read_pdf_file(pdf_file_path: Path) -> str:
-    """Reads the content of a PDF file using pypdf."""
-    text = ""
+    """Reads the content of a PDF file using pypdfium2, or pypdf if that is all we have."""
+    parts: List[str] = []
     try:
-        with open(pdf_file_path, "rb") as pdf_file:
-            pdf_reader = PdfReader(pdf_file)
-            for page in pdf_reader.pages:
-                text += page.extract_text() if page.extract_text() else ""
-        return text
+        if pdfium is not None:
+            pdf = pdfium.PdfDocument(str(pdf_file_path))
+            try:
+                for index in range(len(pdf)):
+                    page = pdf[index]
+                    textpage = page.get_textpage()
+                    parts.append(textpage.get_text_range())
+                    textpage.close()
+                    page.close()
+            finally:
+                pdf.close()
+        elif PdfReader is not None:
+            with open(pdf_file_path, "rb") as pdf_file:
+                pdf_reader = PdfReader(pdf_file)
+                for page in pdf_reader.pages:
+                    parts.append(page.extract_text() or "")
+        return "".join(parts)
     except Exception as e:
         print(f"pdf file {pdf_file_path} is corrupted")
         return ""
 
 
-def download_assets_for_prayer(prayer_dir: str, prayer: Dict[str, Any]) -> None:
+def _download_asset(url: str, dest: str, blob_root: Optional[str]) -> None:
+    if blob_root is None:
+        stream_download(url, dest)
+    else:
+        cached_download(url, dest, blob_root)
+
+
+def _download_track(url: str, dest: str, blob_root: Optional[str] = None) -> None:
+    try:
+        _download_asset(url, dest, blob_root)
+    except Exception as e:
+        print(f"[warn] Failed to download track: {url} -> {dest}: {e}")
+
+
+def _extract_and_write_txt(pdf_path: str, docs_dir: str) -> Optional[str]:
+    """Worker-process job: extract a downloaded PDF's text into a sibling .txt file."""
+    extracted_text = read_pdf_file(Path(pdf_path))
+    if not extracted_text:
+        return None
+    output_file = pdf_to_txt(Path(pdf_path), Path(docs_dir), extracted_text)
+    return str(output_file) if output_file else None
+
+
+def _submit_extraction(pdf_path: str, docs_dir: str) -> Future:
+    pool = _pdf_pool()
+    try:
+        return pool.submit(_extract_and_write_txt, pdf_path, docs_dir)
+    except BrokenProcessPool:
+        # A worker died (e.g. PDFium crashed on a malformed file); start afresh
+        return _pdf_pool(replace=pool).submit(_extract_and_write_txt, pdf_path, docs_dir)
+
+
+def _download_document(
+    url: str, dest: str, docs_dir: str, blob_root: Optional[str] = None
+) -> Optional[PdfJob]:
+    try:
+        _download_asset(url, dest, blob_root)
+    except Exception as e:
+        print(f"[warn] Failed to download document: {url} -> {dest}: {e}")
+        return None
+    # Text extraction is CPU-bound; hand it to the process pool so the
+    # download threads can move on.
+    try:
+        return _submit_extraction(dest, docs_dir), dest, docs_dir
+    except BrokenProcessPool as e:
+        # Even the replacement pool broke (another category's PDF crashed it);
+        # hand back a failed job so _finish_extraction retries it in isolation.
+        failed: Future = Future()
+        failed.set_exception(e)
+        return failed, dest, docs_dir
+    except Exception as e:
+        print(f"[warn] Failed to extract text: {dest}: {e}")
+        return None
+
+
+def _finish_extraction(job: PdfJob) -> None:
+    future, pdf_path, docs_dir = job
+    try:
+        future.result()
+        return
+    except BrokenProcessPool:
+        pass
+    except Exception as e:
+        print(f"[warn] Failed to extract text: {pdf_path}: {e}")
+        return
+    # The shared pool broke while this job was queued or running, possibly
+    # because of another category's PDF. Retry it in a private single-worker
+    # pool so that only a PDF which itself crashes the worker is given up on.
+    try:
+        with ProcessPoolExecutor(max_workers=1, mp_context=_spawn_context()) as pool:
+            pool.submit(_extract_and_write_txt, pdf_path, docs_dir).result()
+    except BrokenProcessPool:
+        print(f"[warn] Failed to extract text: {pdf_path}: PDF worker crashed")
+    except Exception as e:
+        print(f"[warn] Failed to extract text: {pdf_path}: {e}")
+
+
+def download_assets_for_prayer(
+    prayer_dir: str, prayer: Dict[str, Any], blob_root: Optional[str] = None
+) -> List[PdfJob]:
+    """
+    Download all tracks and documents of a prayer concurrently. File names are
+    resolved up front so numbering stays stable regardless of completion order.
+    With blob_root, assets are stored once there and hard-linked into the prayer.
+    Returns the still-running PDF text extraction jobs.
+    """
+    futures: List[Future] = []
+    # Bind hot helpers to locals once; they are looked up for every asset
+    join, splitext, submit = os.path.join, os.path.splitext, _asset_pool().submit
+
     # Audio tracks
     tracks: List[Dict[str, Any]] = prayer.get("tracks") or []
     if tracks:
-        audio_dir = os.path.join(prayer_dir, "audio")
+        audio_dir = join(prayer_dir, "audio")
         ensure_dir(audio_dir)
+        # Names are only deduplicated within this prayer so that files from an
+        # earlier run are revalidated/resumed rather than duplicated.
+        taken: Set[str] = set()
         for index, track in enumerate(tracks, start=1):
-            url = (track or {}).get("url")
+            if not track:
+                continue
+            url = track.get("url")
             if not url:
                 continue
-            preferred_name = (track or {}).get("name") or f"track_{index}"
+            preferred_name = track.get("name") or f"track_{index}"
             fname = filename_from_url(url, f"{preferred_name}.bin")
             # Prefix with index for stable ordering
-            root, ext = os.path.splitext(fname)
+            root, ext = splitext(fname)
             fname = f"{index:02d} - {root}{ext}"
-            fname = unique_filename(audio_dir, fname)
-            dest = os.path.join(audio_dir, fname)
-            try:
-                stream_download(url, dest)
-            except Exception as e:
-                print(f"[warn] Failed to download track: {url} -> {dest}: {e}")
+            fname = unique_filename(fname, taken)
+            dest = join(audio_dir, fname)
+            futures.append(submit(_download_track, url, dest, blob_root))
 
     # Documents (PDFs)
     docs: List[Dict[str, Any]] = prayer.get("documents") or []
     if docs:
-        docs_dir = os.path.join(prayer_dir, "documents")
+        docs_dir = join(prayer_dir, "documents")
         ensure_dir(docs_dir)
+        taken = set()
         for index, doc in enumerate(docs, start=1):
-            url = (doc or {}).get("url")
+            if not doc:
+                continue
+            url = doc.get("url")
             if not url:
                 continue
-            preferred_name = (doc or {}).get("name") or f"document_{index}"
+            preferred_name = doc.get("name") or f"document_{index}"
             fname = filename_from_url(url, f"{preferred_name}.pdf")
             # Prefix with index for stable ordering
-            root, ext = os.path.splitext(fname)
+            root, ext = splitext(fname)
             if not ext:
                 ext = ".pdf"
             fname = f"{index:02d} - {root}{ext}"
-            fname = unique_filename(docs_dir, fname)
-            dest = os.path.join(docs_dir, fname)
-            try:
-                stream_download(url, dest)
-                extracted_text = read_pdf_file(dest)
-                if extracted_text:
-                    pdf_to_txt(dest, docs_dir, extracted_text)
-            except Exception as e:
-                print(f"[warn] Failed to download document: {url} -> {dest}: {e}")
+            fname = unique_filename(fname, taken)
+            dest = join(docs_dir, fname)
+            futures.append(submit(_download_document, url, dest, docs_dir, blob_root))
+
+    wait(futures)
+    extractions = (f.result() for f in futures)
+    return [e for e in extractions if e is not None]
 
 
 def scrape_category(category_id: int, category_title: str, output_root: str) -> int:
     cat_dir = os.path.join(output_root, build_category_dirname(category_id, category_title))
     ensure_dir(cat_dir)
+    blob_root = os.path.join(output_root, BLOB_DIRNAME)
     count = 0
+    extractions: List[PdfJob] = []
     for prayer in iter_prayers(category_id):
         pdir = os.path.join(cat_dir, build_prayer_dirname(prayer))
         ensure_dir(pdir)
         save_metadata(pdir, prayer)
-        download_assets_for_prayer(pdir, prayer)
+        extractions.extend(download_assets_for_prayer(pdir, prayer, blob_root))
         count += 1
+    for job in extractions:
+        _finish_extraction(job)
     return count
 
 
@@ -311,15 +953,26 @@ def main() -> None:
         sys.exit(1)
 
     total_prayers = 0
-    for category_id, category_title in mapping.items():
-        print(f"==> Category {category_id}: {category_title}")
-        try:
-            count = scrape_category(int(category_id), str(category_title), output_root)
-            print(f"    Downloaded {count} prayers.")
-            total_prayers += count
-        except Exception as e:
-            print(f"[error] Category {category_id} failed: {e}", file=sys.stderr)
-            continue
+    # Categories are independent, so crawl them side by side; asset downloads
+    # still share the one session and asset pool.
+    with ThreadPoolExecutor(max_workers=CATEGORY_WORKERS) as pool:
+        futures: List[Tuple[Any, Future]] = []
+        for category_id, category_title in mapping.items():
+            print(f"==> Category {category_id}: {category_title}")
+            try:
+                future = pool.submit(scrape_category, int(category_id), str(category_title), output_root)
+            except Exception as e:
+                print(f"[error] Category {category_id} failed: {e}", file=sys.stderr)
+                continue
+            futures.append((category_id, future))
+        for category_id, future in futures:
+            try:
+                count = future.result()
+                print(f"    Category {category_id}: downloaded {count} prayers.")
+                total_prayers += count
+            except Exception as e:
+                print(f"[error] Category {category_id} failed: {e}", file=sys.stderr)
+                continue
 
     print(f"All done. Total prayers processed: {total_prayers}")
 